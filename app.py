@@ -1,15 +1,58 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from sqlalchemy.orm import make_transient_to_detached
 from datetime import datetime, timedelta, timezone
 from functools import wraps
-from config import Config
+from markupsafe import Markup
+from jinja2 import FileSystemBytecodeCache
+from concurrent.futures import ThreadPoolExecutor
+from config import Config, SMBSettings
+from urllib.parse import quote
+import threading
+import unicodedata
 import os
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# Emit JSON keys in insertion order instead of sorting them on every response
+app.json.sort_keys = False
+
+
+def make_bytecode_cache(directory):
+    """
+    Create the on-disk cache of compiled templates
+    
+    Jinja2 loads these files with marshal, so the directory must not be
+    writable by other users.
+    
+    Args:
+        directory: Cache directory, or None for Jinja2's private per-user one
+        
+    Returns:
+        FileSystemBytecodeCache for the directory
+    """
+    if not directory:
+        # Jinja2 creates it with mode 0700 and checks that it is ours
+        return FileSystemBytecodeCache()
+    
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise RuntimeError(
+            f'JINJA_BYTECODE_CACHE_DIR {directory} must be owned by the current '
+            'user and not writable by others')
+    return FileSystemBytecodeCache(directory)
+
+
+# Compilar todas las plantillas al arrancar (en lugar de en la primera petición
+# a cada ruta) y guardar el bytecode en disco para los demás workers
+app.jinja_env.bytecode_cache = make_bytecode_cache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+for template_name in app.jinja_env.list_templates(extensions=['html']):
+    app.jinja_env.get_template(template_name)
+
 # Importar db desde models y inicializar con app
-from models import db, User
+from models import db, User, as_utc
 db.init_app(app)
 
 # Initialize Flask-Login
@@ -19,7 +62,10 @@ login_manager.login_view = 'login'
 login_manager.login_message = 'Por favor inicie sesión para acceder a esta página.'
 
 from smb_utils import SMBDataRetriever
-from cache_utils import smb_cache
+
+# Leer la configuración SMB una sola vez, no en cada petición
+smb_settings = SMBSettings.from_config(app.config)
+from cache_utils import ThreadSafeCache, smb_cache, image_bytes_cache, SingleFlight
 
 
 def utcnow():
@@ -27,10 +73,156 @@ def utcnow():
     return datetime.now(timezone.utc)
 
 
+# Guards the background SMB refresh so only one refresh thread is started
+_smb_refresh_lock = threading.Lock()
+
+# Shares one SMB scan between all callers that ask for it while it runs
+_smb_scan_flight = SingleFlight()
+
+# Consecutive failed SMB scans. Each failure doubles how long the failed
+# status is cached (and so how long until the next attempt), up to 5 minutes.
+_smb_failures = 0
+SMB_FAILURE_BACKOFF_MAX = 300
+
+# Background threads that download images before they are requested
+_prefetch_executor = ThreadPoolExecutor(max_workers=2)
+
+# Usernames locked by this worker -> locked_until, so repeated attempts
+# against a locked account are rejected without a database round-trip
+login_lockouts = ThreadSafeCache(ttl=app.config['LOCKOUT_DURATION'], max_entries=10000)
+
+# Detached User snapshots by id for load_user, which runs on every
+# authenticated request
+user_cache = ThreadSafeCache(ttl=60, max_entries=1024)
+
+# Result of the /health database check, so frequent polling runs it at most
+# once every 5 seconds
+health_cache = ThreadSafeCache(ttl=5)
+
+
+def refresh_smb_cache():
+    """
+    Scan SMB for JPG images and store the list and connection status in cache
+    
+    Callers arriving while a scan is running wait for it and get its result.
+    """
+    return _smb_scan_flight.run(_scan_smb)
+
+
+def _scan_smb():
+    """Run the SMB scan and update the cache"""
+    global _smb_failures
+    try:
+        # Entering the block raises ConnectionError if the server is
+        # unreachable; the scan alone would report that as an empty list
+        with SMBDataRetriever(smb_settings) as smb_retriever:
+            image_list = smb_retriever.scan_for_jpg_images()
+        smb_connection_status = {
+            'connected': True,
+            'images_found': len(image_list),
+            'last_check': utcnow().isoformat()
+        }
+        _smb_failures = 0
+        ttl = None
+    except Exception as e:
+        # Keep serving the last good list during an outage; only a cold
+        # start has nothing better than an empty one
+        image_list = smb_cache.get_stale('jpg_image_list') or []
+        smb_connection_status = {
+            'connected': False,
+            'error': str(e),
+            'last_check': utcnow().isoformat()
+        }
+        _smb_failures += 1
+        ttl = min(smb_cache.ttl * 2 ** (_smb_failures - 1), SMB_FAILURE_BACKOFF_MAX)
+    
+    smb_cache.set('jpg_image_list', image_list, tags=['smb:images'], ttl=ttl)
+    smb_cache.set('smb_status', smb_connection_status, tags=['smb:status'], ttl=ttl)
+    if smb_connection_status['connected']:
+        prefetch_images(image_list)
+    return image_list, smb_connection_status
+
+
+def prefetch_images(image_list):
+    """Download the first images of the list in background, before they are clicked"""
+    # Drop prefetched copies of files the scan shows were replaced on the share
+    for image in image_list:
+        cached_image = image_bytes_cache.get(image['full_path'])
+        if cached_image is not None and not _matches_scan(cached_image, image):
+            image_bytes_cache.invalidate(image['full_path'])
+    
+    for image in image_list[:app.config['IMAGE_PREFETCH_COUNT']]:
+        future = _prefetch_executor.submit(_prefetch_image, image)
+        future.add_done_callback(
+            lambda future, image_path=image['full_path']: _log_prefetch_error(future, image_path))
+
+
+def _matches_scan(cached_image, image):
+    """Whether a prefetched (last_write_time, bytes) entry matches a scanned image"""
+    last_write_time, data = cached_image
+    return (len(data) == image['file_size'] and
+            datetime.fromtimestamp(last_write_time).isoformat() == image['last_write_time'])
+
+
+def _log_prefetch_error(future, image_path):
+    """Log the exception of a failed prefetch instead of dropping it"""
+    exception = future.exception()
+    if exception is not None:
+        app.logger.error('Error prefetching image %s', image_path, exc_info=exception)
+
+
+def _prefetch_image(image):
+    """Store an image's modification time and contents in image_bytes_cache"""
+    image_path = image['full_path']
+    cached_image = image_bytes_cache.get(image_path)
+    if cached_image is not None and _matches_scan(cached_image, image):
+        return
+    
+    smb_retriever = SMBDataRetriever(smb_settings)
+    attributes = smb_retriever.get_file_attributes(image_path)
+    if attributes is None or attributes.isDirectory:
+        return
+    
+    data = b''.join(smb_retriever.iter_image_file(image_path))
+    # A read error ends the iteration early; never cache a partial file
+    if len(data) == attributes.file_size:
+        image_bytes_cache.set(image_path, (attributes.last_write_time, data))
+
+
+def refresh_smb_cache_async():
+    """Refresh the SMB cache in a background thread unless a refresh is already running"""
+    if not _smb_refresh_lock.acquire(blocking=False):
+        return
+    
+    def worker():
+        try:
+            refresh_smb_cache()
+        finally:
+            _smb_refresh_lock.release()
+    
+    threading.Thread(target=worker, daemon=True).start()
+
+
 @login_manager.user_loader
 def load_user(user_id):
     """Load user by ID for Flask-Login"""
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    snapshot = user_cache.get(user_id)
+    if snapshot is None:
+        # Session.get() checks the identity map before querying, unlike the
+        # legacy Query.get()
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        # Keep a copy outside any session so commits in this request do not
+        # expire the cached attributes
+        snapshot = User(**{column.key: getattr(user, column.key)
+                           for column in User.__table__.columns})
+        make_transient_to_detached(snapshot)
+        user_cache.set(user_id, snapshot)
+        return user
+    # Attach a copy to this request's session without querying the database
+    return db.session.merge(snapshot, load=False)
 
 
 def admin_required(f):
@@ -58,13 +250,22 @@ def login():
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
+        # One timestamp for every check and update in this request
+        now = utcnow()
+        
+        # Known lockout: reject before querying the user or hashing the password
+        locked_until = login_lockouts.get(username)
+        if locked_until is not None and locked_until > now:
+            remaining_time = (locked_until - now).total_seconds()
+            flash(f'Cuenta bloqueada. Intente nuevamente en {int(remaining_time)} segundos.', 'error')
+            return render_template('login.html')
         
         user = User.query.filter_by(username=username).first()
         
         if user:
             # Check if account is locked
-            if user.is_locked():
-                remaining_time = (user.locked_until - utcnow()).total_seconds()
+            if user.is_locked(now):
+                remaining_time = (as_utc(user.locked_until) - now).total_seconds()
                 flash(f'Cuenta bloqueada. Intente nuevamente en {int(remaining_time)} segundos.', 'error')
                 return render_template('login.html')
             
@@ -73,8 +274,9 @@ def login():
                 # Reset failed attempts on successful login
                 user.failed_login_attempts = 0
                 user.locked_until = None
-                user.last_login = utcnow()
+                user.last_login = now
                 db.session.commit()
+                user_cache.invalidate(user.id)
                 
                 # Set session to be permanent with 24-hour expiration
                 session.permanent = True
@@ -86,15 +288,20 @@ def login():
             else:
                 # Increment failed attempts
                 user.failed_login_attempts += 1
+                user_cache.invalidate(user.id)
                 
                 # Lock account if max attempts reached
-                if user.failed_login_attempts >= app.config['MAX_LOGIN_ATTEMPTS']:
-                    user.locked_until = utcnow() + timedelta(seconds=app.config['LOCKOUT_DURATION'])
-                    db.session.commit()
+                remaining = app.config['MAX_LOGIN_ATTEMPTS'] - user.failed_login_attempts
+                if remaining <= 0:
+                    user.locked_until = now + timedelta(seconds=app.config['LOCKOUT_DURATION'])
+                    login_lockouts.set(username, user.locked_until)
+                
+                # Single write for the counter and, if reached, the lockout
+                db.session.commit()
+                
+                if remaining <= 0:
                     flash(f'Cuenta bloqueada por {app.config["LOCKOUT_DURATION"]//60} minutos debido a múltiples intentos fallidos.', 'error')
                 else:
-                    db.session.commit()
-                    remaining = app.config['MAX_LOGIN_ATTEMPTS'] - user.failed_login_attempts
                     flash(f'Usuario o contraseña incorrectos. Intentos restantes: {remaining}', 'error')
         else:
             flash('Usuario o contraseña incorrectos.', 'error')
@@ -120,8 +327,8 @@ def create_user():
         password = request.form.get('password')
         is_admin = request.form.get('is_admin') == 'on'
         
-        # Check if username already exists
-        if User.query.filter_by(username=username).first():
+        # Check if username already exists (EXISTS, no row is loaded)
+        if db.session.query(User.query.filter_by(username=username).exists()).scalar():
             flash('El nombre de usuario ya existe.', 'error')
             return render_template('create_user.html')
         
@@ -163,76 +370,125 @@ def image_viewer():
     image_list = smb_cache.get('jpg_image_list')
     smb_connection_status = smb_cache.get('smb_status')
     
-    if image_list is None:
-        try:
-            smb_retriever = SMBDataRetriever(app.config)
-            image_list = smb_retriever.scan_for_jpg_images()
-            smb_connection_status = {
-                'connected': True,
-                'images_found': len(image_list),
-                'last_check': utcnow().isoformat()
-            }
-        except Exception as e:
-            image_list = []
-            smb_connection_status = {
-                'connected': False,
-                'error': str(e),
-                'last_check': utcnow().isoformat()
-            }
-        
-        # Cache the data
-        smb_cache.set('jpg_image_list', image_list)
-        smb_cache.set('smb_status', smb_connection_status)
+    if image_list is None or smb_connection_status is None:
+        image_list = smb_cache.get_stale('jpg_image_list')
+        smb_connection_status = smb_cache.get_stale('smb_status')
+        if image_list is None or smb_connection_status is None:
+            # Nothing cached yet, scan while the user waits. Concurrent
+            # requests wait for the same scan instead of starting their own,
+            # and the scan caches both entries with its own (backoff) ttl.
+            image_list, smb_connection_status = refresh_smb_cache()
+        else:
+            # Serve the stale list and refresh it in background
+            refresh_smb_cache_async()
+    
+    # The image list markup is the same for every user, so it is rendered once
+    # per scan and reused until the next scan replaces the list
+    list_version = smb_connection_status.get('last_check')
+    cached_html = smb_cache.get_stale('jpg_image_list_html')
+    if cached_html is not None and cached_html[0] == list_version:
+        image_list_html = cached_html[1]
+    else:
+        image_list_html = Markup(render_template('image_list.html', images=image_list))
+        smb_cache.set('jpg_image_list_html', (list_version, image_list_html),
+                      tags=['smb:images'])
     
     return render_template('image_viewer.html',
                          images=image_list,
+                         image_list_html=image_list_html,
                          smb_status=smb_connection_status)
 
 
 @app.route('/api/image/<path:image_path>')
 def get_image(image_path):
-    """Serve an image from SMB"""
+    """Serve an image from SMB, streamed in chunks instead of buffered in memory"""
     try:
-        smb_retriever = SMBDataRetriever(app.config)
-        image_data = smb_retriever.get_image_file(image_path)
-        
-        if image_data:
-            return send_file(
-                image_data,
-                mimetype='image/jpeg',
-                as_attachment=False,
-                download_name=os.path.basename(image_path)
-            )
+        # Prefetched images are keyed by full_path, which starts with '/';
+        # the URL path arrives without it
+        cached_image = image_bytes_cache.get('/' + image_path.lstrip('/'))
+        chunks = None
+        if cached_image is not None:
+            last_write_time, data = cached_image
+            file_size = len(data)
+            response = Response(data, mimetype='image/jpeg')
         else:
-            return jsonify({'error': 'Image not found'}), 404
+            smb_retriever = SMBDataRetriever(smb_settings)
+            attributes = smb_retriever.get_file_attributes(image_path)
+            
+            if attributes is None or attributes.isDirectory:
+                return jsonify({'error': 'Image not found'}), 404
+            
+            last_write_time = attributes.last_write_time
+            file_size = attributes.file_size
+            chunks = smb_retriever.iter_image_file(image_path)
+            response = Response(mimetype='image/jpeg')
+        
+        response.headers.set('Content-Disposition', 'inline',
+                             **_content_disposition_names(os.path.basename(image_path)))
+        response.content_length = file_size
+        response.last_modified = datetime.fromtimestamp(last_write_time, timezone.utc)
+        response.set_etag(f'{int(last_write_time):x}-{file_size:x}')
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['IMAGE_CACHE_MAX_AGE']
+        
+        # Answers 304 without reading the file when the browser's copy is current
+        response = response.make_conditional(request)
+        if chunks is not None and response.status_code == 200:
+            # Read the first chunk before sending the headers, so a file that
+            # cannot be read is still answered with an error instead of an
+            # empty body
+            first_chunk = next(chunks, b'')
+            if file_size and not first_chunk:
+                chunks.close()
+                return jsonify({'error': 'Error reading image'}), 500
+            response.response = stream_with_context(_prepend_chunk(first_chunk, chunks))
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def _content_disposition_names(filename):
+    """
+    Build the Content-Disposition filename parameters the way send_file does
+    
+    Args:
+        filename: Name of the file as stored on the share
+        
+    Returns:
+        Dictionary with an ASCII filename, plus an RFC 5987 filename* when
+        the name is not ASCII
+    """
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        # safe = RFC 5987 attr-char
+        quoted = quote(filename, safe="!#$&+-.^_`|~")
+        return {'filename': simple, 'filename*': f"UTF-8''{quoted}"}
+    return {'filename': filename}
+
+
+def _prepend_chunk(first_chunk, chunks):
+    """Yield an already read chunk and then the rest of the file"""
+    yield first_chunk
+    yield from chunks
+
+
 @app.route('/api/refresh-images', methods=['POST'])
 def refresh_images():
     """Refresh the image list from SMB"""
-    try:
-        smb_retriever = SMBDataRetriever(app.config)
-        image_list = smb_retriever.scan_for_jpg_images()
-        
-        # Update cache
-        smb_cache.set('jpg_image_list', image_list)
-        smb_cache.set('smb_status', {
-            'connected': True,
-            'images_found': len(image_list),
-            'last_check': utcnow().isoformat()
-        })
-        
-        return jsonify({
-            'success': True,
-            'images_found': len(image_list)
-        })
-    except Exception as e:
+    image_list, smb_connection_status = refresh_smb_cache()
+    
+    if not smb_connection_status['connected']:
         return jsonify({
             'success': False,
-            'error': str(e)
+            'error': smb_connection_status['error']
         }), 500
+    
+    return jsonify({
+        'success': True,
+        'images_found': len(image_list)
+    })
 
 
 # ============================================================================
@@ -241,8 +497,12 @@ def refresh_images():
 
 @app.route('/api/cache/invalidate', methods=['POST'])
 def invalidate_cache():
-    """Invalidate cache manually"""
-    smb_cache.invalidate()
+    """Invalidate cache manually (only entries tagged ?tag=... if given)"""
+    tag = request.args.get('tag')
+    if tag:
+        smb_cache.invalidate_tag(tag)
+    else:
+        smb_cache.invalidate()
     
     return jsonify({
         'success': True,
@@ -262,6 +522,21 @@ def cache_stats():
 # HEALTH CHECK
 # ============================================================================
 
+def check_database():
+    """Run the database health check"""
+    try:
+        user_count = User.query.count()
+        return {
+            'status': 'healthy',
+            'user_count': user_count
+        }
+    except Exception as e:
+        return {
+            'status': 'error',
+            'error': str(e)
+        }
+
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
@@ -272,45 +547,26 @@ def health():
         'smb': {}
     }
     
-    try:
-        # Check database
-        user_count = User.query.count()
-        health_status['database'] = {
-            'status': 'healthy',
-            'user_count': user_count
-        }
-    except Exception as e:
+    # Check database (cached briefly, concurrent requests share one check)
+    health_status['database'] = health_cache.get_or_set('database', check_database)
+    if health_status['database']['status'] != 'healthy':
         health_status['status'] = 'degraded'
-        health_status['database'] = {
-            'status': 'error',
-            'error': str(e)
-        }
     
-    # Check SMB connection
+    # Check SMB connection. Never scan inline: serve the last known status
+    # and let a background thread refresh it when it has expired.
     smb_status_data = smb_cache.get('smb_status')
     if smb_status_data is None:
-        try:
-            smb_retriever = SMBDataRetriever(app.config)
-            connected = smb_retriever.connect()
-            if connected:
-                images = smb_retriever.scan_for_jpg_images()
-                images_found = len(images)
-            else:
-                images_found = 0
-            smb_retriever.disconnect()
-            
-            health_status['smb'] = {
-                'status': 'healthy' if connected else 'disconnected',
-                'images_found': images_found
-            }
-        except Exception as e:
-            health_status['status'] = 'degraded'
-            health_status['smb'] = {
-                'status': 'error',
-                'error': str(e)
-            }
+        smb_status_data = smb_cache.get_stale('smb_status')
+        refresh_smb_cache_async()
+    
+    if smb_status_data is None:
+        health_status['smb'] = {
+            'status': 'checking'
+        }
     else:
         health_status['smb'] = smb_status_data
+        if not smb_status_data.get('connected'):
+            health_status['status'] = 'degraded'
     
     return jsonify(health_status)
 
@@ -324,8 +580,9 @@ def init_db():
     with app.app_context():
         db.create_all()
         
-        # Create default admin user if no users exist
-        if User.query.count() == 0:
+        # Create default admin user if no users exist (SELECT ... LIMIT 1
+        # instead of counting the whole table)
+        if db.session.query(User.id).first() is None:
             admin = User(username='admin', is_admin=True)
             admin.set_password('admin')  # Default password - should be changed
             db.session.add(admin)
@@ -337,16 +594,7 @@ def init_db():
 
 if __name__ == '__main__':
     # Crear las tablas si no existen
-    with app.app_context():
-        db.create_all()
-        
-        # Create default admin user if no users exist
-        if User.query.count() == 0:
-            admin = User(username='admin', is_admin=True)
-            admin.set_password('admin')
-            db.session.add(admin)
-            db.session.commit()
-            print("Default admin user created (username: admin, password: admin)")
+    init_db()
     
     # Ejecutar la aplicación
     app.run(debug=True, host='0.0.0.0', port=5000)
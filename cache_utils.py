@@ -1,23 +1,54 @@
 """
 Cache utility module with thread-safe operations
 """
-from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, defaultdict, deque
+import heapq
+import itertools
 import threading
+import time
 
 
 class ThreadSafeCache:
-    """Thread-safe cache implementation with TTL support"""
+    """Thread-safe LRU cache implementation with TTL support"""
     
-    def __init__(self, ttl=30):
+    def __init__(self, ttl=30, stale_ttl=0, max_entries=None, max_bytes=None, sizeof=None):
         """
         Initialize cache
         
         Args:
             ttl: Time to live in seconds (default: 30)
+            stale_ttl: Extra seconds an expired entry is kept so it can still
+                be served through get_stale() while it is refreshed (default: 0)
+            max_entries: Maximum number of entries, least recently used are
+                evicted first (default: no limit)
+            max_bytes: Maximum total size of the values as measured by sizeof
+                (default: no limit)
+            sizeof: Callable returning the size of a value, required with max_bytes
         """
-        self.cache = {}
+        # key -> (value, expiry). Expiry is a time.monotonic() deadline:
+        # unaffected by clock changes and cheaper to read than datetime.now()
+        self.cache = OrderedDict()
         self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.sizes = {}
+        self.total_bytes = 0
         self.lock = threading.Lock()
+        # Per-key locks used by get_or_set so only one caller computes a value
+        self.key_locks = defaultdict(threading.Lock)
+        # Reverse index tag -> keys, used by invalidate_tag, and key -> tags
+        # so a removal only touches the tags of that key
+        self.tags = defaultdict(set)
+        self.key_tags = {}
+        # Min-heap of (expiry, seq, key); entries replaced by a later set()
+        # stay in the heap and are skipped when popped
+        self.expiry_heap = []
+        self.expiry_seq = itertools.count()
+        # Expired entries still inside the stale window, oldest first
+        self.expired_keys = set()
+        self.stale_queue = deque()
     
     def get(self, key):
         """
@@ -32,24 +63,108 @@ class ThreadSafeCache:
         with self.lock:
             if key in self.cache:
                 value, expiry = self.cache[key]
-                if datetime.now(timezone.utc) < expiry:
+                now = time.monotonic()
+                if now < expiry:
+                    self.cache.move_to_end(key)
                     return value
-                else:
-                    # Remove expired entry
-                    del self.cache[key]
+                elif now >= expiry + self.stale_ttl:
+                    # Remove entry once it is past the stale window too
+                    self._remove(key)
         return None
     
-    def set(self, key, value):
+    def get_stale(self, key):
         """
-        Set value in cache
+        Get value from cache even if it has expired, as long as it is still
+        within the stale window
+        
+        Args:
+            key: Cache key
+            
+        Returns:
+            Cached value (fresh or stale) or None if not found
+        """
+        with self.lock:
+            if key in self.cache:
+                value, expiry = self.cache[key]
+                if time.monotonic() < expiry + self.stale_ttl:
+                    self.cache.move_to_end(key)
+                    return value
+                self._remove(key)
+        return None
+    
+    def set(self, key, value, tags=(), ttl=None):
+        """
+        Set value in cache, evicting the least recently used entries if the
+        cache is over its limits
         
         Args:
             key: Cache key
             value: Value to cache
+            tags: Tags the entry depends on, for invalidate_tag()
+            ttl: Time to live in seconds for this entry (default: the cache ttl)
         """
+        size = self.sizeof(value) if self.sizeof else 0
         with self.lock:
-            expiry = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+            if key in self.cache:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # Would evict everything else and still not fit
+                return
+            
+            now = time.monotonic()
+            self._expire(now)
+            
+            expiry = now + (self.ttl if ttl is None else ttl)
             self.cache[key] = (value, expiry)
+            heapq.heappush(self.expiry_heap, (expiry, next(self.expiry_seq), key))
+            if self.sizeof:
+                self.sizes[key] = size
+                self.total_bytes += size
+            if tags:
+                self.key_tags[key] = set(tags)
+                for tag in tags:
+                    self.tags[tag].add(key)
+            
+            while ((self.max_entries is not None and len(self.cache) > self.max_entries) or
+                   (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                self._remove(next(iter(self.cache)))
+    
+    def get_or_set(self, key, loader, tags=()):
+        """
+        Get value from cache, computing it with loader on a miss
+        
+        Concurrent callers missing the same key wait for the first one
+        instead of all running loader at once.
+        
+        Args:
+            key: Cache key
+            loader: Callable returning the value to cache
+            tags: Tags the entry depends on, for invalidate_tag()
+            
+        Returns:
+            Cached or freshly computed value
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        
+        with self.lock:
+            key_lock = self.key_locks[key]
+        
+        try:
+            with key_lock:
+                # Another caller may have filled the entry while we waited
+                value = self.get(key)
+                if value is None:
+                    value = loader()
+                    self.set(key, value, tags)
+        finally:
+            # Drop the lock once nobody needs it, unless a later caller
+            # already replaced it with a new one
+            with self.lock:
+                if self.key_locks.get(key) is key_lock:
+                    del self.key_locks[key]
+        return value
     
     def invalidate(self, key=None):
         """
@@ -61,8 +176,58 @@ class ThreadSafeCache:
         with self.lock:
             if key is None:
                 self.cache.clear()
+                self.tags.clear()
+                self.key_tags.clear()
+                self.sizes.clear()
+                self.total_bytes = 0
+                self.expiry_heap.clear()
+                self.expired_keys.clear()
+                self.stale_queue.clear()
             elif key in self.cache:
-                del self.cache[key]
+                self._remove(key)
+    
+    def invalidate_tag(self, tag):
+        """
+        Invalidate every entry associated with a tag
+        
+        Args:
+            tag: Tag passed to set() when the entries were stored
+        """
+        with self.lock:
+            for key in self.tags.pop(tag, ()):
+                self._remove(key)
+    
+    def _remove(self, key):
+        """Remove an entry and its tag references (caller holds the lock)"""
+        self.cache.pop(key, None)
+        self.total_bytes -= self.sizes.pop(key, 0)
+        self.expired_keys.discard(key)
+        for tag in self.key_tags.pop(key, ()):
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+    
+    def _expire(self, now):
+        """
+        Move entries that reached their expiry to the stale window, and drop
+        those past it (caller holds the lock)
+        
+        Only the heap top is inspected, so the cost is proportional to the
+        number of entries that expired since the last call.
+        """
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expiry, _, key = heapq.heappop(self.expiry_heap)
+            if key in self.cache and self.cache[key][1] == expiry:
+                self.expired_keys.add(key)
+                self.stale_queue.append((expiry, key))
+        
+        deadline = now - self.stale_ttl
+        while self.stale_queue and self.stale_queue[0][0] <= deadline:
+            expiry, key = self.stale_queue.popleft()
+            if key in self.cache and self.cache[key][1] == expiry:
+                self._remove(key)
     
     def get_stats(self):
         """
@@ -72,21 +237,58 @@ class ThreadSafeCache:
             Dictionary with cache stats
         """
         with self.lock:
+            self._expire(time.monotonic())
             total_entries = len(self.cache)
-            expired_entries = 0
-            now = datetime.now(timezone.utc)
-            
-            for key, (value, expiry) in list(self.cache.items()):
-                if now >= expiry:
-                    expired_entries += 1
+            expired_entries = len(self.expired_keys)
             
-            return {
+            stats = {
                 'total_entries': total_entries,
                 'active_entries': total_entries - expired_entries,
                 'expired_entries': expired_entries,
                 'ttl': self.ttl
             }
+            if self.max_entries is not None:
+                stats['max_entries'] = self.max_entries
+            if self.max_bytes is not None:
+                stats['total_bytes'] = self.total_bytes
+                stats['max_bytes'] = self.max_bytes
+            return stats
+
+
+class SingleFlight:
+    """Coalesce concurrent calls so callers that arrive during a run share its result"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.result = None
+    
+    def run(self, func):
+        """
+        Run func unless another thread is already running it, in which case
+        wait for that run and return its result
+        
+        Args:
+            func: Callable to run
+            
+        Returns:
+            Result of func (this call's or the shared one)
+        """
+        generation = self.generation
+        with self.lock:
+            if self.generation != generation:
+                # A run finished while we waited for the lock
+                return self.result
+            self.result = func()
+            self.generation += 1
+            return self.result
+
 
+# Global cache instance for SMB data. Expired entries are kept for 5 more
+# minutes so requests can be served stale while a refresh runs in background.
+smb_cache = ThreadSafeCache(ttl=30, stale_ttl=300, max_entries=1024)
 
-# Global cache instance for SMB data
-smb_cache = ThreadSafeCache(ttl=30)
+# Image contents fetched ahead of time, keyed by SMB path. Values are
+# (last_write_time, bytes); at most 128 MiB of image data per process.
+image_bytes_cache = ThreadSafeCache(ttl=300, max_bytes=128 * 1024 * 1024,
+                                    sizeof=lambda entry: len(entry[1]))
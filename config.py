@@ -1,4 +1,5 @@
 import os
+from collections import namedtuple
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,6 +10,16 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///operations.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Reusar conexiones del pool: verificarlas antes de usarlas y reciclarlas
+    # cada 30 minutos para no heredar conexiones cerradas por el servidor
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_pre_ping': True,
+        'pool_recycle': 1800
+    }
+    # Tamaño del pool para servidores de base de datos (SQLite no lo admite)
+    if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS['pool_size'] = int(os.environ.get('DB_POOL_SIZE', 20))
+        SQLALCHEMY_ENGINE_OPTIONS['max_overflow'] = int(os.environ.get('DB_MAX_OVERFLOW', 40))
     
     # Configuración de sesión
     PERMANENT_SESSION_LIFETIME = 86400  # 24 horas en segundos
@@ -27,19 +38,86 @@ class Config:
     SMB_USERNAME = os.environ.get('SMB_USERNAME', 'orexplore')
     SMB_PASSWORD = os.environ.get('SMB_PASSWORD', 'en6Eith0aphi')
     SMB_DOMAIN = os.environ.get('SMB_DOMAIN', 'WORKGROUP')
+    # SMB directo sobre TCP (puerto 445) evita la negociación de sesión
+    # NetBIOS; SMB_USE_NETBIOS=true vuelve al puerto 139 para servidores antiguos
+    SMB_USE_NETBIOS = os.environ.get('SMB_USE_NETBIOS', 'false').lower() in ('1', 'true', 'yes')
+    SMB_PORT = int(os.environ.get('SMB_PORT', 139 if SMB_USE_NETBIOS else 445))
     
     # Base path for scanning (within the SMB share)
     # Set to '/' to scan from root, or specify a subfolder like 'incoming/Orexplore'
     # .jpg files should be two folders deep after pond/incoming/Orexplore/
     SMB_BASE_SCAN_PATH = os.environ.get('SMB_BASE_SCAN_PATH', '/incoming/Orexplore')
     
+    # Number of directories listed in parallel while scanning (one SMB
+    # connection each)
+    SMB_SCAN_WORKERS = int(os.environ.get('SMB_SCAN_WORKERS', 8))
+    
+    # Bytes requested per read when streaming a file from SMB
+    SMB_READ_CHUNK_SIZE = int(os.environ.get('SMB_READ_CHUNK_SIZE', 4 * 1024 * 1024))
+    
     # Configuración de la aplicación
     OPERATIONS_PER_PAGE = 20
     BATCHES_PER_PAGE = 30
     
     # Configuración de caché
     CACHE_TTL = 30  # Time to live en segundos
+    # Segundos que el navegador puede reutilizar una imagen sin revalidarla
+    IMAGE_CACHE_MAX_AGE = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 300))
+    # Imágenes del principio de la lista que se descargan a memoria tras cada
+    # escaneo (0 para desactivar)
+    IMAGE_PREFETCH_COUNT = int(os.environ.get('IMAGE_PREFETCH_COUNT', 20))
+    
+    # Directorio donde se guardan las plantillas Jinja2 compiladas, compartido
+    # entre workers y reinicios. Sin valor, Jinja2 usa un directorio privado
+    # del usuario (modo 0700) dentro del directorio temporal.
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
     
     # URLs externas configurables
     TELEMETRY_URL = os.environ.get('TELEMETRY_URL', 'http://example.com/telemetry')
     MINERALS_URL = os.environ.get('MINERALS_URL', 'http://172.16.11.155:8005/get_html')
+
+
+class SMBSettings(namedtuple('SMBSettings', [
+        'server_name', 'server_ip', 'port', 'use_netbios', 'share_name',
+        'username', 'password', 'domain', 'base_scan_path', 'scan_workers',
+        'read_chunk_size'])):
+    """Configuración SMB inmutable, leída una sola vez de la configuración"""
+    __slots__ = ()
+    
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the settings from a mapping with the SMB_* keys
+        
+        Args:
+            config: Flask config or any mapping with the SMB_* settings
+            
+        Returns:
+            SMBSettings instance
+            
+        Raises:
+            ValueError: If SMB_READ_CHUNK_SIZE is not a positive number of bytes
+        """
+        read_chunk_size = config.get('SMB_READ_CHUNK_SIZE', 4 * 1024 * 1024)
+        if read_chunk_size <= 0:
+            # pysmb reads nothing with 0 and the whole file with -1, so the
+            # chunked reader would never reach the end of the file
+            raise ValueError(f'SMB_READ_CHUNK_SIZE must be positive, got {read_chunk_size}')
+        
+        return cls(
+            server_name=config['SMB_SERVER_NAME'],
+            server_ip=config['SMB_SERVER_IP'],
+            port=config.get('SMB_PORT', 445),
+            use_netbios=config.get('SMB_USE_NETBIOS', False),
+            share_name=config['SMB_SHARE_NAME'],
+            username=config['SMB_USERNAME'],
+            password=config['SMB_PASSWORD'],
+            domain=config['SMB_DOMAIN'],
+            base_scan_path=config.get('SMB_BASE_SCAN_PATH', '/'),
+            scan_workers=config.get('SMB_SCAN_WORKERS', 8),
+            read_chunk_size=read_chunk_size
+        )
+
+
+# Configuración SMB por defecto, construida a partir de Config
+SMB_SETTINGS = SMBSettings.from_config(vars(Config))
@@ -1,16 +1,37 @@
 from datetime import datetime, timezone
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
 db = SQLAlchemy()
 
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL journaling on SQLite so readers do not block on writers"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+
 def utcnow():
     """Get current UTC time (timezone-aware)"""
     return datetime.now(timezone.utc)
 
 
+def as_utc(value):
+    """Treat a naive datetime as UTC (SQLite returns stored datetimes without offset)"""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
 class User(UserMixin, db.Model):
     """Modelo para usuarios del sistema"""
     __tablename__ = 'users'
@@ -32,12 +53,47 @@ class User(UserMixin, db.Model):
         """Check if password matches"""
         return check_password_hash(self.password_hash, password)
     
-    def is_locked(self):
-        """Check if account is locked due to failed attempts"""
-        if self.locked_until and self.locked_until > utcnow():
+    def is_locked(self, now=None):
+        """
+        Check if account is locked due to failed attempts
+        
+        Args:
+            now: Current UTC time, to reuse a timestamp the caller already has
+        """
+        if now is None:
+            now = utcnow()
+        locked_until = as_utc(self.locked_until)
+        if locked_until and locked_until > now:
             return True
         return False
     
     def __repr__(self):
         return f'<User {self.username}>'
 
+
+def bulk_create_users(rows):
+    """
+    Crear varios usuarios con un solo INSERT en lugar de uno por usuario
+    
+    Los nombres de usuario que ya existen se omiten en SQLite y PostgreSQL.
+    
+    Args:
+        rows: Iterable de tuplas (username, password_hash, is_admin)
+    """
+    values = [
+        {'username': username, 'password_hash': password_hash, 'is_admin': is_admin}
+        for username, password_hash, is_admin in rows
+    ]
+    if not values:
+        return
+    
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(User.__table__).on_conflict_do_nothing(index_elements=['username'])
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(User.__table__).on_conflict_do_nothing(index_elements=['username'])
+    else:
+        stmt = User.__table__.insert()
+    
+    db.session.execute(stmt, values)
+    db.session.commit()
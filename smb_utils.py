@@ -1,51 +1,207 @@
 from smb.SMBConnection import SMBConnection
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-import tempfile
-import os
 import io
 import re
+import threading
+import time
 import logging
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Entradas de directorio actual y padre que devuelve listPath
+_SKIP = frozenset(('.', '..'))
 
-class SMBDataRetriever:
-    """Clase para recuperar datos del servidor SMB"""
+# Todas las variantes de mayúsculas de la extensión .jpg: endswith() con una
+# tupla evita crear una copia en minúsculas de cada nombre listado
+_JPG_SUFFIXES = ('.jpg', '.jpG', '.jPg', '.jPG', '.Jpg', '.JpG', '.JPg', '.JPG')
+
+# Profundidades en nombres tipo core_from_X_to_Y.ext; el valor "to" termina
+# en el primer '.' (la extensión)
+_DEPTH_FROM_RE = re.compile(r'(?:^|_)from_([^_]*)', re.IGNORECASE)
+_DEPTH_TO_RE = re.compile(r'(?:^|_)to_([^_.]*)', re.IGNORECASE)
+
+
+class SMBConnectionPool:
+    """Pool de conexiones SMB autenticadas reutilizables entre peticiones"""
     
-    def __init__(self, config):
-        self.config = config
-        self.connection = None
+    def __init__(self, max_idle=4, max_idle_time=60, probe_after=5):
+        """
+        Initialize pool
+        
+        Args:
+            max_idle: Maximum number of idle connections kept open per
+                server and user (default: 4)
+            max_idle_time: Seconds an idle connection is kept before it is
+                closed (default: 60)
+            probe_after: Seconds a connection must have been idle before it
+                is checked with an ECHO on reuse (default: 5)
+        """
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self.probe_after = probe_after
+        # (server, port, user) -> list of (connection, released_at)
+        self._idle = {}
+        self._lock = threading.Lock()
     
-    def connect(self):
-        """Establecer conexión con el servidor SMB"""
+    def _key(self, settings):
+        """Connections can only be shared between identical server and credentials"""
+        return (settings.server_ip, settings.port, settings.server_name,
+                settings.domain, settings.username)
+    
+    def acquire(self, settings):
+        """
+        Get a live connection, reusing an idle one when possible
+        
+        Args:
+            settings: SMBSettings with the connection settings
+            
+        Returns:
+            Connected SMBConnection or None if the server is unreachable
+        """
+        key = self._key(settings)
+        while True:
+            with self._lock:
+                expired = self._evict_expired()
+                idle = self._idle.get(key)
+                connection, released_at = idle.pop() if idle else (None, None)
+            for old_connection in expired:
+                self._close(old_connection)
+            if connection is None:
+                break
+            # A connection released moments ago is reused without a round
+            # trip; only those idle for a while are probed
+            if (time.monotonic() - released_at < self.probe_after or
+                    self._is_alive(connection)):
+                return connection
+            self._close(connection)
+        
+        return self._open(settings)
+    
+    def release(self, settings, connection):
+        """
+        Return a connection to the pool, closing it if the pool is full
+        
+        Args:
+            settings: SMBSettings the connection was acquired with
+            connection: SMBConnection obtained from acquire()
+        """
+        with self._lock:
+            idle = self._idle.setdefault(self._key(settings), [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.monotonic()))
+                return
+        self._close(connection)
+    
+    def _evict_expired(self):
+        """
+        Remove connections idle for longer than max_idle_time (caller holds
+        the lock) and return them so they can be closed outside the lock
+        """
+        deadline = time.monotonic() - self.max_idle_time
+        expired = []
+        for key in list(self._idle):
+            idle = self._idle[key]
+            # Connections are appended on release, so the oldest are first
+            while idle and idle[0][1] < deadline:
+                expired.append(idle.pop(0)[0])
+            if not idle:
+                del self._idle[key]
+        return expired
+    
+    def _open(self, settings):
+        """Establecer una nueva conexión con el servidor SMB"""
         try:
-            self.connection = SMBConnection(
-                username=self.config['SMB_USERNAME'],
-                password=self.config['SMB_PASSWORD'],
+            connection = SMBConnection(
+                username=settings.username,
+                password=settings.password,
                 my_name='portal-operaciones',
-                remote_name=self.config['SMB_SERVER_NAME'],
-                domain=self.config['SMB_DOMAIN'],
-                use_ntlm_v2=True
+                remote_name=settings.server_name,
+                domain=settings.domain,
+                use_ntlm_v2=True,
+                is_direct_tcp=not settings.use_netbios
             )
             
             # Conectar al servidor con timeout
-            connected = self.connection.connect(
-                self.config['SMB_SERVER_IP'],
-                139,  # Puerto SMB
+            connected = connection.connect(
+                settings.server_ip,
+                settings.port,  # 445 (TCP directo) o 139 (NetBIOS)
                 timeout=5  # 5 segundos de timeout
             )
             
-            return connected
+            return connection if connected else None
         except Exception as e:
-            print(f"Error al conectar con servidor SMB: {str(e)}")
+            logger.error("Error al conectar con servidor SMB: %s", e)
+            return None
+    
+    def _is_alive(self, connection):
+        """Comprobar con un ECHO que una conexión inactiva sigue abierta"""
+        try:
+            connection.echo(b'ping', timeout=2)
+            return True
+        except Exception:
             return False
     
+    def _close(self, connection):
+        """Cerrar una conexión descartada sin propagar errores"""
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+class SMBDataRetriever:
+    """Clase para recuperar datos del servidor SMB"""
+    
+    __slots__ = ('settings', 'connection', '_depth')
+    
+    def __init__(self, settings):
+        """
+        Initialize retriever
+        
+        Args:
+            settings: SMBSettings con los datos de conexión
+        """
+        self.settings = settings
+        self.connection = None
+        # Llamadas a connect() sin su disconnect() correspondiente
+        self._depth = 0
+    
+    def __enter__(self):
+        """Mantener una conexión abierta durante todo el bloque with"""
+        if not self.connect():
+            raise ConnectionError('No se pudo conectar con el servidor SMB')
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
+        return False
+    
+    def connect(self):
+        """
+        Obtener una conexión con el servidor SMB desde el pool
+        
+        Si ya hay una conexión abierta (por ejemplo dentro de un bloque with)
+        se reutiliza en lugar de pedir otra.
+        """
+        if self.connection is None:
+            self.connection = smb_pool.acquire(self.settings)
+            if self.connection is None:
+                return False
+        self._depth += 1
+        return True
+    
     def disconnect(self):
-        """Cerrar conexión con el servidor SMB"""
-        if self.connection:
-            self.connection.close()
+        """Devolver la conexión con el servidor SMB al pool cuando ya nadie la usa"""
+        if self.connection is None:
+            return
+        self._depth -= 1
+        if self._depth <= 0:
+            smb_pool.release(self.settings, self.connection)
             self.connection = None
+            self._depth = 0
     
     def get_operation_data(self, core_id, machine_id):
         """
@@ -70,17 +226,18 @@ class SMBDataRetriever:
             # Listar archivos en el share
             try:
                 files = self.connection.listPath(
-                    self.config['SMB_SHARE_NAME'],
+                    self.settings.share_name,
                     search_path
                 )
                 
                 for file_info in files:
-                    if file_info.filename not in ['.', '..'] and not file_info.isDirectory:
+                    if file_info.filename not in _SKIP and not file_info.isDirectory:
+                        depth_from, depth_to = self._extract_depths_from_filename(file_info.filename)
                         data.append({
                             'file_path': f"{search_path}/{file_info.filename}",
                             'file_size': file_info.file_size,
-                            'depth_from': self._extract_depth_from_filename(file_info.filename, 'from'),
-                            'depth_to': self._extract_depth_from_filename(file_info.filename, 'to'),
+                            'depth_from': depth_from,
+                            'depth_to': depth_to,
                             'quality': 'good',  # Valor por defecto
                             'metadata': {
                                 'create_time': datetime.fromtimestamp(file_info.create_time).isoformat(),
@@ -89,10 +246,10 @@ class SMBDataRetriever:
                         })
             except Exception as e:
                 # Si no se encuentra el path, retornar lista vacía
-                print(f"No se encontraron datos para {search_path}: {str(e)}")
+                logger.warning("No se encontraron datos para %s: %s", search_path, e)
         
         except Exception as e:
-            print(f"Error al obtener datos de operación: {str(e)}")
+            logger.error("Error al obtener datos de operación: %s", e)
         finally:
             self.disconnect()
         
@@ -113,68 +270,76 @@ class SMBDataRetriever:
             
             # Listar máquinas (directorios de nivel superior)
             machines = self.connection.listPath(
-                self.config['SMB_SHARE_NAME'],
+                self.settings.share_name,
                 '/'
             )
-            
-            for machine in machines:
-                if machine.isDirectory and machine.filename not in ['.', '..']:
-                    machine_id = machine.filename
-                    
-                    # Listar núcleos dentro de cada máquina
-                    try:
-                        cores = self.connection.listPath(
-                            self.config['SMB_SHARE_NAME'],
-                            f"/{machine_id}/"
-                        )
-                        
-                        for core in cores:
-                            if core.isDirectory and core.filename not in ['.', '..']:
-                                core_id = core.filename
-                                
-                                operations.append({
-                                    'core_id': core_id,
-                                    'machine_id': machine_id,
-                                    'scan_date': datetime.fromtimestamp(core.create_time),
-                                    'depth_from': 0.0,
-                                    'depth_to': 0.0
-                                })
-                    except Exception as e:
-                        print(f"Error listando cores para máquina {machine_id}: {str(e)}")
+            machine_ids = [
+                machine.filename for machine in machines
+                if machine.isDirectory and machine.filename not in _SKIP
+            ]
+            
+            # Listar los núcleos de todas las máquinas en paralelo
+            with self._parallel_workers() as parallel_map:
+                machine_cores = parallel_map(self._list_cores, machine_ids, [])
+            
+            for machine_id, cores in zip(machine_ids, machine_cores):
+                for core in cores:
+                    operations.append({
+                        'core_id': core.filename,
+                        'machine_id': machine_id,
+                        'scan_date': datetime.fromtimestamp(core.create_time),
+                        'depth_from': 0.0,
+                        'depth_to': 0.0
+                    })
         
         except Exception as e:
-            print(f"Error escaneando servidor SMB: {str(e)}")
+            logger.error("Error escaneando servidor SMB: %s", e)
         finally:
             self.disconnect()
         
         return operations
     
-    def _extract_depth_from_filename(self, filename, field):
+    def _list_cores(self, connection, machine_id):
+        """
+        Listar los núcleos (subdirectorios) de una máquina
+        
+        Args:
+            connection: Conexión SMB a usar
+            machine_id: ID de la máquina
+            
+        Returns:
+            Lista de SharedFile de los directorios de núcleo
+        """
+        try:
+            cores = connection.listPath(
+                self.settings.share_name,
+                f"/{machine_id}/"
+            )
+            return [core for core in cores
+                    if core.isDirectory and core.filename not in _SKIP]
+        except Exception as e:
+            logger.warning("Error listando cores para máquina %s: %s", machine_id, e)
+            return []
+    
+    def _extract_depths_from_filename(self, filename):
         """
         Extraer información de profundidad del nombre del archivo
         Asume formato: core_from_X_to_Y.ext o similar
         
         Args:
             filename: Nombre del archivo
-            field: 'from' o 'to'
             
         Returns:
-            Valor de profundidad o 0.0 si no se puede extraer
+            Tupla (depth_from, depth_to); 0.0 en los valores que no se pueden extraer
         """
-        try:
-            parts = filename.lower().split('_')
-            if field == 'from' and 'from' in parts:
-                idx = parts.index('from')
-                if idx + 1 < len(parts):
-                    return float(parts[idx + 1])
-            elif field == 'to' and 'to' in parts:
-                idx = parts.index('to')
-                if idx + 1 < len(parts):
-                    return float(parts[idx + 1].split('.')[0])
-        except:
-            pass
-        
-        return 0.0
+        depths = []
+        for pattern in (_DEPTH_FROM_RE, _DEPTH_TO_RE):
+            match = pattern.search(filename)
+            try:
+                depths.append(float(match.group(1)) if match else 0.0)
+            except ValueError:
+                depths.append(0.0)
+        return tuple(depths)
     
     def _normalize_path(self, path):
         """
@@ -209,70 +374,155 @@ class SMBDataRetriever:
                 return jpg_files
             
             # Get base scan path from configuration
-            base_path = self.config.get('SMB_BASE_SCAN_PATH', '/')
+            base_path = self.settings.base_scan_path
             
             # Normalize base path
             base_path = self._normalize_path(base_path)
             
-            logger.info(f"Starting recursive JPG scan from base path: {base_path}")
+            logger.info("Starting recursive JPG scan from base path: %s", base_path)
             
             # Escanear recursivamente desde la ruta base configurada
-            jpg_files = self._scan_directory_recursive(base_path, jpg_files)
+            jpg_files = self._scan_directory_tree(base_path)
             
-            logger.info(f"Scan complete. Found {len(jpg_files)} JPG files")
+            logger.info("Scan complete. Found %d JPG files", len(jpg_files))
             
             # Filtrar solo imágenes que están en batch-xxx.xx/sample-N
             filtered_files = self._filter_batch_sample_images(jpg_files)
             
-            logger.info(f"After filtering: {len(filtered_files)} JPG files")
+            logger.info("After filtering: %d JPG files", len(filtered_files))
         
         except Exception as e:
-            logger.error(f"Error scanning SMB server for JPG: {str(e)}")
+            logger.error("Error scanning SMB server for JPG: %s", e)
             filtered_files = []
         finally:
             self.disconnect()
         
         return filtered_files
     
-    def _scan_directory_recursive(self, path, jpg_files):
+    @contextmanager
+    def _parallel_workers(self):
+        """
+        Hilos para ejecutar operaciones SMB en paralelo, cada uno con su
+        propia conexión
+        
+        El primer hilo usa la conexión actual del retriever; los demás piden
+        una al pool la primera vez y la conservan hasta el final del bloque,
+        cuando se devuelven todas.
+        
+        Yields:
+            Función parallel_map(func, items, default) que ejecuta
+            func(connection, item) para cada elemento y devuelve los
+            resultados en orden (default si el hilo no obtiene conexión)
+        """
+        local = threading.local()
+        spare = [self.connection] if self.connection is not None else []
+        connections = []
+        connections_lock = threading.Lock()
+        
+        def call(func, default, item):
+            # Cada hilo reutiliza una sola conexión durante todo el bloque
+            connection = getattr(local, 'connection', None)
+            if connection is None:
+                with connections_lock:
+                    connection = spare.pop() if spare else None
+                if connection is None:
+                    connection = smb_pool.acquire(self.settings)
+                    if connection is None:
+                        logger.warning("No SMB connection available for %s", item)
+                        return default
+                    with connections_lock:
+                        connections.append(connection)
+                local.connection = connection
+            return func(connection, item)
+        
+        try:
+            with ThreadPoolExecutor(max_workers=self.settings.scan_workers) as executor:
+                yield lambda func, items, default: list(
+                    executor.map(lambda item: call(func, default, item), items))
+        finally:
+            for connection in connections:
+                smb_pool.release(self.settings, connection)
+    
+    def _scan_directory_tree(self, base_path):
+        """
+        Escanear un árbol de directorios en busca de archivos JPG
+        
+        El árbol se recorre por niveles y los directorios de cada nivel se
+        listan en paralelo con _parallel_workers(), para que las latencias de
+        red de los listados se solapen.
+        
+        Args:
+            base_path: Ruta del directorio raíz del escaneo
+            
+        Returns:
+            Lista de archivos JPG encontrados, en el mismo orden que un
+            recorrido recursivo en profundidad
+        """
+        # Contenido de cada directorio: lista de ('dir', ruta) y ('file', info)
+        entries = {}
+        frontier = [base_path]
+        with self._parallel_workers() as parallel_map:
+            while frontier:
+                next_frontier = []
+                for path, path_entries in zip(frontier, parallel_map(self._list_directory, frontier, [])):
+                    entries[path] = path_entries
+                    next_frontier.extend(item for kind, item in path_entries if kind == 'dir')
+                frontier = next_frontier
+        
+        # Recorrer el resultado en profundidad para conservar el orden original
+        jpg_files = []
+        stack = [iter(entries[base_path])]
+        while stack:
+            for kind, item in stack[-1]:
+                if kind == 'dir':
+                    stack.append(iter(entries[item]))
+                    break
+                jpg_files.append(item)
+            else:
+                stack.pop()
+        
+        return jpg_files
+    
+    def _list_directory(self, connection, path):
         """
-        Escanear un directorio de forma recursiva en busca de archivos JPG
+        Listar un directorio y extraer sus subdirectorios y archivos JPG
         
         Args:
-            path: Ruta del directorio a escanear
-            jpg_files: Lista acumulativa de archivos JPG encontrados
+            connection: Conexión SMB a usar
+            path: Ruta del directorio a listar
             
         Returns:
-            Lista actualizada de archivos JPG
+            Lista de tuplas ('dir', ruta) y ('file', info_jpg) en el orden del listado
         """
+        path_entries = []
+        
         try:
-            logger.debug(f"Scanning directory: {path}")
+            logger.debug("Scanning directory: %s", path)
             
             # Listar contenido del directorio
-            items = self.connection.listPath(
-                self.config['SMB_SHARE_NAME'],
+            items = connection.listPath(
+                self.settings.share_name,
                 path
             )
             
             dir_count = 0
             file_count = 0
+            # Prefijo común de las rutas de las entradas de este directorio
+            prefix = path if path.endswith('/') else f"{path}/"
             
             for item in items:
                 # Saltar referencias de directorio actual y padre
-                if item.filename in ['.', '..']:
+                if item.filename in _SKIP:
                     continue
                 
                 # Construir ruta completa
-                if path.endswith('/'):
-                    item_path = f"{path}{item.filename}"
-                else:
-                    item_path = f"{path}/{item.filename}"
+                item_path = prefix + item.filename
                 
                 if item.isDirectory:
                     dir_count += 1
-                    # Si es un directorio, escanear recursivamente
-                    jpg_files = self._scan_directory_recursive(item_path, jpg_files)
-                elif item.filename.lower().endswith('.jpg'):
+                    # Si es un directorio, se escanea en el siguiente nivel
+                    path_entries.append(('dir', item_path))
+                elif item.filename.endswith(_JPG_SUFFIXES):
                     file_count += 1
                     # Si es un archivo JPG, agregarlo a la lista
                     # Extraer información de la ruta para organización
@@ -284,8 +534,7 @@ class SMBDataRetriever:
                         'file_size': item.file_size,
                         'create_time': datetime.fromtimestamp(item.create_time).isoformat(),
                         'last_write_time': datetime.fromtimestamp(item.last_write_time).isoformat(),
-                        'folder_path': '/'.join(path_parts[:-1]) if len(path_parts) > 1 else '/',
-                        'path_parts': path_parts
+                        'folder_path': '/'.join(path_parts[:-1]) if len(path_parts) > 1 else '/'
                     }
                     
                     # Agregar información de organización jerárquica
@@ -296,15 +545,15 @@ class SMBDataRetriever:
                         jpg_info['machine_id'] = path_parts[0] if path_parts else ''
                         jpg_info['core_id'] = ''
                     
-                    jpg_files.append(jpg_info)
+                    path_entries.append(('file', jpg_info))
             
             if dir_count > 0 or file_count > 0:
-                logger.debug(f"  {path}: found {dir_count} subdirectories, {file_count} JPG files")
+                logger.debug("  %s: found %d subdirectories, %d JPG files", path, dir_count, file_count)
         
         except Exception as e:
-            logger.warning(f"Error scanning directory {path}: {str(e)}")
+            logger.warning("Error scanning directory %s: %s", path, e)
         
-        return jpg_files
+        return path_entries
     
     def _filter_batch_sample_images(self, jpg_files):
         """
@@ -325,7 +574,9 @@ class SMBDataRetriever:
         sample_pattern = re.compile(r'sample-(\d+)', re.IGNORECASE)
         
         for jpg in jpg_files:
-            path_parts = jpg.get('path_parts', [])
+            # Las partes de la ruta se derivan de full_path aquí en vez de
+            # guardar una lista extra por cada imagen escaneada
+            path_parts = jpg['full_path'].strip('/').split('/')
             
             # Buscar batch-xxx.xx y sample-N en la ruta
             batch_value = None
@@ -404,6 +655,85 @@ class SMBDataRetriever:
         
         return filtered
     
+    def get_file_attributes(self, file_path):
+        """
+        Obtener los atributos (tamaño, fechas) de un archivo del servidor SMB
+        
+        Args:
+            file_path: Ruta completa del archivo en el servidor SMB
+            
+        Returns:
+            SharedFile con los atributos del archivo o None si hay error
+        """
+        try:
+            if not self.connect():
+                return None
+            
+            return self.connection.getAttributes(
+                self.settings.share_name,
+                file_path
+            )
+        
+        except Exception as e:
+            logger.warning("Error obteniendo atributos de %s: %s", file_path, e)
+            return None
+        finally:
+            self.disconnect()
+    
+    def iter_image_file(self, file_path, chunk_size=None):
+        """
+        Leer un archivo de imagen del servidor SMB por bloques
+        
+        La conexión se obtiene al empezar a iterar y se devuelve al pool al
+        terminar, por lo que un generador que nunca se itera no ocupa ninguna.
+        
+        Args:
+            file_path: Ruta completa del archivo en el servidor SMB
+            chunk_size: Bytes leídos por bloque (default: settings.read_chunk_size)
+            
+        Yields:
+            Bloques de bytes del archivo
+            
+        Raises:
+            Exception: Si la lectura falla después de haber entregado algún
+                bloque, para que el servidor corte la respuesta en lugar de
+                terminar un archivo truncado
+        """
+        if chunk_size is None:
+            chunk_size = self.settings.read_chunk_size
+        
+        # Si ya se entregó algún bloque, un error no puede silenciarse
+        started = False
+        try:
+            if not self.connect():
+                return
+            
+            offset = 0
+            while True:
+                chunk = io.BytesIO()
+                _, bytes_read = self.connection.retrieveFileFromOffset(
+                    self.settings.share_name,
+                    file_path,
+                    chunk,
+                    offset,
+                    chunk_size
+                )
+                if bytes_read:
+                    started = True
+                    yield chunk.getvalue()
+                # Una lectura de 0 bytes es el final del archivo, aunque
+                # chunk_size no sea positivo
+                if not bytes_read or bytes_read < chunk_size:
+                    break
+                offset += bytes_read
+        
+        except Exception as e:
+            logger.warning("Error leyendo imagen %s: %s", file_path, e)
+            if started:
+                raise
+        finally:
+            self.disconnect()
+    
     def get_image_file(self, file_path):
         """
         Obtener un archivo de imagen del servidor SMB
@@ -423,7 +753,7 @@ class SMBDataRetriever:
             
             # Descargar archivo del servidor SMB
             self.connection.retrieveFile(
-                self.config['SMB_SHARE_NAME'],
+                self.settings.share_name,
                 file_path,
                 file_obj
             )
@@ -434,7 +764,12 @@ class SMBDataRetriever:
             return file_obj
         
         except Exception as e:
-            print(f"Error obteniendo imagen {file_path}: {str(e)}")
+            logger.warning("Error obteniendo imagen %s: %s", file_path, e)
             return None
         finally:
             self.disconnect()
+
+
+# Global pool of SMB connections shared by all SMBDataRetriever instances.
+# Sized to keep the connections of a parallel scan open for the next one.
+smb_pool = SMBConnectionPool(max_idle=8, max_idle_time=60)
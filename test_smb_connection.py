@@ -18,8 +18,9 @@ Features:
 
 import sys
 import os
+from collections import Counter
 from datetime import datetime
-from config import Config
+from config import Config, SMB_SETTINGS
 from smb_utils import SMBDataRetriever
 
 
@@ -50,17 +51,21 @@ def print_info(text):
     print(f"ℹ {text}")
 
 
+# Config attributes shown in the configuration section, in display order
+_SMB_CFG_KEYS = (
+    'SMB_SERVER_NAME',
+    'SMB_SERVER_IP',
+    'SMB_SHARE_NAME',
+    'SMB_USERNAME',
+    'SMB_PASSWORD',
+    'SMB_DOMAIN',
+    'SMB_BASE_SCAN_PATH',
+)
+
+
 def get_smb_config():
     """Get SMB configuration dictionary"""
-    return {
-        'SMB_SERVER_NAME': Config.SMB_SERVER_NAME,
-        'SMB_SERVER_IP': Config.SMB_SERVER_IP,
-        'SMB_SHARE_NAME': Config.SMB_SHARE_NAME,
-        'SMB_USERNAME': Config.SMB_USERNAME,
-        'SMB_PASSWORD': Config.SMB_PASSWORD,
-        'SMB_DOMAIN': Config.SMB_DOMAIN,
-        'SMB_BASE_SCAN_PATH': Config.SMB_BASE_SCAN_PATH
-    }
+    return {key: getattr(Config, key) for key in _SMB_CFG_KEYS}
 
 
 def join_smb_path(base_path, filename):
@@ -79,8 +84,7 @@ def test_smb_connection():
     # Display configuration
     print_section("Configuration")
     config = get_smb_config()
-    config_display = config.copy()
-    config_display['SMB_PASSWORD'] = '***' if config['SMB_PASSWORD'] else 'Not set'
+    config_display = {**config, 'SMB_PASSWORD': '***' if config['SMB_PASSWORD'] else 'Not set'}
     
     for key, value in config_display.items():
         print(f"  {key}: {value}")
@@ -88,7 +92,7 @@ def test_smb_connection():
     # Test 1: Initialize SMB Retriever
     print_section("Test 1: Initialize SMB Data Retriever")
     try:
-        smb_retriever = SMBDataRetriever(config)
+        smb_retriever = SMBDataRetriever(SMB_SETTINGS)
         print_success("SMB Data Retriever initialized successfully")
     except Exception as e:
         print_error(f"Failed to initialize SMB Data Retriever: {str(e)}")
@@ -126,16 +130,30 @@ def test_smb_connection():
             base_path
         )
         
-        folders = [item for item in items if item.isDirectory and item.filename not in ['.', '..']]
-        files = [item for item in items if not item.isDirectory]
+        # Count entries in one pass, keeping only the first ones for the preview
+        PREVIEW_COUNT = 10
+        folders = []
+        files = []
+        folder_count = 0
+        file_count = 0
+        for item in items:
+            if item.isDirectory:
+                if item.filename in ('.', '..'):
+                    continue
+                folder_count += 1
+                if folder_count <= PREVIEW_COUNT:
+                    folders.append(item)
+            else:
+                file_count += 1
+                if file_count <= PREVIEW_COUNT:
+                    files.append(item)
         
         print_success(f"Successfully accessed share '{Config.SMB_SHARE_NAME}'")
-        print_info(f"Found {len(folders)} folders and {len(files)} files at base level")
+        print_info(f"Found {folder_count} folders and {file_count} files at base level")
         
         if folders:
             print_info("\nFirst 10 folders at base level:")
-            for i, folder in enumerate(folders[:10]):
-                print(f"    {i+1}. {folder.filename}/")
+            print("\n".join(f"    {i+1}. {folder.filename}/" for i, folder in enumerate(folders)))
             
             # Test accessing folders up to 3 levels deep
             print_info("\nVerifying folder access at multiple depths:")
@@ -157,10 +175,11 @@ def test_smb_connection():
                     subdirs = [item for item in items if item.isDirectory and item.filename not in ['.', '..']]
                     
                     if subdirs:
+                        prefix = join_smb_path(current_path, '')
                         for subdir in subdirs[:MAX_SUBDIRS_PER_LEVEL]:
                             if checked_count >= MAX_DEPTH_CHECKS:
                                 break
-                            subdir_path = join_smb_path(current_path, subdir.filename)
+                            subdir_path = prefix + subdir.filename
                             print(f"    ✓ Depth {depth}: {subdir_path}")
                             checked_count += 1
                             checked_count = check_folder_depth(subdir_path, depth + 1, max_depth, checked_count)
@@ -181,9 +200,8 @@ def test_smb_connection():
         
         if files:
             print_info(f"\nFirst 10 files at base level:")
-            for i, file in enumerate(files[:10]):
-                size_mb = file.file_size / (1024 * 1024)
-                print(f"    {i+1}. {file.filename} ({size_mb:.2f} MB)")
+            print("\n".join(f"    {i+1}. {file.filename} ({file.file_size / (1024 * 1024):.2f} MB)"
+                            for i, file in enumerate(files)))
                 
     except Exception as e:
         print_error(f"Failed to access share: {str(e)}")
@@ -198,10 +216,7 @@ def test_smb_connection():
     print_section("Test 4: Scan for JPG Images")
     jpg_files = []
     try:
-        # Disconnect first as scan_for_jpg_images handles its own connection
-        if smb_retriever.connection:
-            smb_retriever.disconnect()
-        
+        # The connection opened in Test 2 is reused by the scan and by Test 5
         print_info("Starting recursive JPG scan...")
         print_info("This may take a few moments depending on folder structure...")
         
@@ -212,15 +227,10 @@ def test_smb_connection():
             
             # Calculate depth information relative to base path
             base_path = Config.SMB_BASE_SCAN_PATH or '/'
-            max_depth = 0
-            depth_counts = {}
-            
-            for jpg in jpg_files:
-                path_parts = jpg.get('path_parts', [])
-                # Calculate depth from the base path
-                depth = len(path_parts) - 1  # -1 because filename is the last part
-                max_depth = max(max_depth, depth)
-                depth_counts[depth] = depth_counts.get(depth, 0) + 1
+            # Calculate depth from the base path (filename is the last part)
+            depth_counts = Counter(jpg.get('full_path', '').strip('/').count('/')
+                                   for jpg in jpg_files)
+            max_depth = max(depth_counts)
             
             print_info(f"\nFolder depth analysis (relative to {base_path}):")
             print_info(f"  Maximum folder depth scanned: {max_depth} levels")
@@ -234,25 +244,22 @@ def test_smb_connection():
                 print_info(f"Note: Currently only found files up to depth {max_depth}")
             
             print_info("\nFirst 10 JPG files:")
+            # Each preview is written with a single print call
+            lines = []
             for i, jpg in enumerate(jpg_files[:10]):
                 display_name = jpg.get('display_name', jpg.get('filename', 'Unknown'))
                 folder = jpg.get('folder_path', '')
-                path_parts = jpg.get('path_parts', [])
-                depth = len(path_parts) - 1
+                depth = jpg.get('full_path', '').strip('/').count('/')
                 size_kb = jpg.get('file_size', 0) / 1024
-                print(f"    {i+1}. {display_name}")
-                print(f"       Path: {folder}")
-                print(f"       Depth: {depth} levels")
-                print(f"       Size: {size_kb:.2f} KB")
+                lines.append(f"    {i+1}. {display_name}")
+                lines.append(f"       Path: {folder}")
+                lines.append(f"       Depth: {depth} levels")
+                lines.append(f"       Size: {size_kb:.2f} KB")
+            print("\n".join(lines))
                 
             # Show summary statistics
             print_info("\nSummary by machine/folder:")
-            machines = {}
-            for jpg in jpg_files:
-                machine = jpg.get('machine_id', 'Unknown')
-                if machine not in machines:
-                    machines[machine] = 0
-                machines[machine] += 1
+            machines = Counter(jpg.get('machine_id', 'Unknown') for jpg in jpg_files)
             
             for machine, count in sorted(machines.items()):
                 print(f"    {machine}: {count} images")
@@ -264,6 +271,7 @@ def test_smb_connection():
             
     except Exception as e:
         print_error(f"Failed to scan for JPG images: {str(e)}")
+        smb_retriever.disconnect()
         return False
     
     # Test 5: Test Image Retrieval (if images found)
@@ -276,7 +284,7 @@ def test_smb_connection():
             image_data = smb_retriever.get_image_file(test_image['full_path'])
             
             if image_data:
-                image_size = len(image_data.getvalue())
+                image_size = image_data.getbuffer().nbytes
                 print_success(f"Successfully retrieved image ({image_size} bytes)")
             else:
                 print_error("Failed to retrieve image data")
@@ -284,6 +292,8 @@ def test_smb_connection():
         except Exception as e:
             print_error(f"Failed to retrieve image: {str(e)}")
     
+    smb_retriever.disconnect()
+    
     # Summary
     print_header("Test Summary")
     print_success("All tests completed successfully!")